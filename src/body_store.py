@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+@file body_store.py
+@brief Content-addressed on-disk storage for cached response bodies.
+"""
+
+import aiofiles
+import aiofiles.os
+import hashlib
+import os
+import uuid
+from config import CACHE_DIR
+
+
+class BodyWriter:
+    """
+    @brief Streams a response body into a temporary file while hashing it.
+
+    The file is moved to its content-addressed location on commit, so a
+    partially written body is never visible to readers.
+    """
+
+    def __init__(self, store, tmp_path, file):
+        """
+        @brief Initialize the BodyWriter.
+        @param store The owning BodyStore.
+        @param tmp_path Path of the temporary file being written.
+        @param file The open aiofiles handle for tmp_path.
+        """
+        self.store = store
+        self.tmp_path = tmp_path
+        self.file = file
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.done = False
+
+    async def write(self, chunk: bytes):
+        """
+        @brief Append a chunk to the body.
+        @param chunk The bytes to append.
+        """
+        self.digest.update(chunk)
+        self.size += len(chunk)
+        await self.file.write(chunk)
+
+    async def commit(self):
+        """
+        @brief Finish the body and move it to its content-addressed location.
+        @return The path of the stored body, relative to the cache directory.
+        """
+        await self.file.close()
+        self.done = True
+        path = self.store.path_for(self.digest.hexdigest())
+        full_path = self.store.full_path(path)
+        await aiofiles.os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        await aiofiles.os.replace(self.tmp_path, full_path)
+        return path
+
+    async def abort(self):
+        """
+        @brief Discard the body. Does nothing if it was already committed.
+        """
+        if self.done:
+            return
+        self.done = True
+        await self.file.close()
+        try:
+            await aiofiles.os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class BodyStore:
+    """
+    @brief Stores response bodies as files named after their SHA-256 digest.
+
+    Bodies live under cache_dir/aa/bbcc..., which keeps large payloads out of
+    the SQLite database; the cache table only records the relative path.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        """
+        @brief Initialize the BodyStore.
+        @param cache_dir Directory holding the cached bodies.
+        """
+        self.cache_dir = cache_dir
+        self.tmp_dir = os.path.join(cache_dir, "tmp")
+
+    def init(self):
+        """
+        @brief Create the cache directory and drop bodies left half-written.
+        """
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        for name in os.listdir(self.tmp_dir):
+            os.remove(os.path.join(self.tmp_dir, name))
+
+    @staticmethod
+    def path_for(digest: str):
+        """
+        @brief Map a hex digest to its relative storage path.
+        @param digest The SHA-256 hex digest of the body.
+        @return The relative path of the body.
+        """
+        return os.path.join(digest[:2], digest[2:])
+
+    def full_path(self, path: str):
+        """
+        @brief Resolve a relative body path inside the cache directory.
+        @param path The relative path of the body.
+        @return The absolute path of the body.
+        """
+        return os.path.join(self.cache_dir, path)
+
+    async def open_writer(self):
+        """
+        @brief Start writing a new body.
+        @return A BodyWriter for the new body.
+        """
+        tmp_path = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        file = await aiofiles.open(tmp_path, "wb")
+        return BodyWriter(self, tmp_path, file)
+
+    def size(self, path: str):
+        """
+        @brief Get the size of a stored body.
+        @param path The relative path of the body.
+        @return The size in bytes, or None if the body is missing.
+        """
+        try:
+            return os.stat(self.full_path(path)).st_size
+        except FileNotFoundError:
+            return None
+
+    def remove(self, path: str):
+        """
+        @brief Delete a stored body if it still exists.
+        @param path The relative path of the body.
+        """
+        try:
+            os.remove(self.full_path(path))
+        except FileNotFoundError:
+            pass
+
+    def remove_unreferenced(self, referenced: set):
+        """
+        @brief Delete stored bodies that no cache entry points to.
+        @param referenced Set of relative paths that are still in use.
+        """
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_dir() or entry.path == self.tmp_dir:
+                continue
+            for body in os.scandir(entry.path):
+                if os.path.join(entry.name, body.name) not in referenced:
+                    os.remove(body.path)
@@ -8,7 +8,11 @@ import os
 
 PORT = int(os.getenv("PORT", 3142))
 DB_NAME = os.getenv("DB_NAME", "/app/data/cache.db")
+CACHE_DIR = os.getenv("CACHE_DIR", "/app/data/cache")
 CACHE_EXPIRATION_SECONDS = int(os.getenv("CACHE_EXPIRATION_SECONDS", 2592000))
 MAX_CONCURRENT_CONNECTIONS = int(os.getenv("MAX_CONCURRENT_CONNECTIONS", 100))
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", 10))
 BATCH_INTERVAL = float(os.getenv("BATCH_INTERVAL", 1.0))
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", BATCH_SIZE * 8))
+CHECKPOINT_INTERVAL = int(os.getenv("CHECKPOINT_INTERVAL", 100))
+MEMORY_CACHE_MAX_ITEM_SIZE = int(os.getenv("MEMORY_CACHE_MAX_ITEM_SIZE", 4 * 1024 * 1024))
@@ -6,9 +6,76 @@
 
 import aiosqlite
 import asyncio
-import json
-from datetime import datetime, timedelta
-from config import DB_NAME, CACHE_EXPIRATION_SECONDS, BATCH_SIZE, BATCH_INTERVAL
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from body_store import BodyStore
+from logger import logger
+from config import (
+    DB_NAME,
+    CACHE_DIR,
+    CACHE_EXPIRATION_SECONDS,
+    BATCH_SIZE,
+    BATCH_INTERVAL,
+    CHECKPOINT_INTERVAL,
+    WRITE_QUEUE_SIZE,
+)
+
+# Bump whenever the layout of the cache table changes.
+SCHEMA_VERSION = 8
+
+# Kept as a single constant so sqlite3's statement cache reuses the
+# compiled statement across batches.
+_INSERT_SQL = (
+    "INSERT OR REPLACE INTO cache "
+    "(url, path, response_head, expected_size, timestamp) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
+
+# Per-connection tuning applied to both the reader and the writer.
+# Cached responses can be fetched again, so commits skip fsync entirely.
+_TUNING_PRAGMAS = """
+    PRAGMA synchronous=OFF;
+    PRAGMA cache_size=-64000;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    PRAGMA busy_timeout=5000;
+"""
+
+
+def _is_corruption(error):
+    """
+    @brief Tell whether an sqlite3 error means the database file is damaged.
+
+    Corruption ("file is not a database", "database disk image is malformed")
+    is reported as a plain DatabaseError; its subclasses, OperationalError in
+    particular, cover conditions such as a locked database or a full disk.
+
+    @param error The sqlite3 exception.
+    @return True if the database should be recreated.
+    """
+    return type(error) is sqlite3.DatabaseError
+
+
+class BatchQueue(asyncio.Queue):
+    """
+    @brief asyncio.Queue that can hand out every ready item in one call.
+
+    Avoids calling get_nowait in a loop until it raises QueueEmpty.
+    """
+
+    def drain_up_to(self, n: int):
+        """
+        @brief Remove and return up to n items without waiting.
+        @param n Maximum number of items to take.
+        @return The items taken, oldest first; empty if the queue is empty.
+        """
+        items = [self._get() for _ in range(min(n, self.qsize()))]
+        # Same bookkeeping as get_nowait: each freed slot may admit a waiting put.
+        for _ in items:
+            self._wakeup_next(self._putters)
+        return items
 
 
 class CacheDatabase:
@@ -17,64 +84,233 @@ class CacheDatabase:
 
     Provides methods to initialize the database, verify data integrity,
     perform batch writes, query cached responses, and shut down the database.
+    Response bodies are kept on disk by a BodyStore; rows only hold their path.
     """
 
-    def __init__(self, db_name=DB_NAME):
+    def __init__(self, db_name=DB_NAME, cache_dir=CACHE_DIR):
         """
         @brief Initialize the CacheDatabase instance.
         @param db_name Database file name.
+        @param cache_dir Directory holding the cached response bodies.
         """
         self.db_name = db_name
-        self.conn = None
-        self.lock = asyncio.Lock()
-        self.write_queue = asyncio.Queue()
+        self.store = BodyStore(cache_dir)
+        self.read_conn = None
+        # Plain sqlite3 connection, created and used only on the writer thread.
+        self.write_conn = None
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-writer")
+        self.batches_since_checkpoint = 0
+        # Bounded so that cache_response blocks fetchers when the writer falls behind.
+        self.write_queue = BatchQueue(maxsize=WRITE_QUEUE_SIZE)
         self.worker_task = None
 
-    async def init(self):
+    async def _run_writer(self, func, *args):
         """
-        @brief Initialize the database connection, create table if needed,
-               verify integrity, and start the background write worker.
+        @brief Run a function on the writer thread, which owns the write connection.
+        @param func The function to run.
+        @param args Positional arguments for func.
+        @return The value returned by func.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.writer, func, *args)
+
+    async def _connect(self):
+        """
+        @brief Open a read connection to the database and apply the tuning PRAGMAs.
+        @return The opened aiosqlite connection.
+        """
+        conn = await aiosqlite.connect(self.db_name)
+        await conn.execute("PRAGMA journal_mode=WAL;")
+        await conn.executescript(_TUNING_PRAGMAS)
+        return conn
+
+    def _open_writer(self):
+        """
+        @brief Open the write connection and create the tables if needed.
+
+        Runs on the writer thread. The connection is in autocommit mode;
+        transactions are delimited with explicit BEGIN statements.
+
+        The cache table is clustered on url (WITHOUT ROWID): rows are small now
+        that bodies live on disk, so a lookup reads the row straight from the
+        primary key B-tree instead of going through a separate url index.
+
+        The path index lets _write_batch check cheaply whether a replaced body
+        file is still referenced before deleting it.
+
+        The total body size is kept in the metadata table by triggers, so it
+        is updated in the same transaction as every insert and delete.
         """
-        self.conn = await aiosqlite.connect(self.db_name)
-        await self.conn.execute("PRAGMA journal_mode=WAL;")
-        await self.conn.execute(
+        conn = self.write_conn = sqlite3.connect(self.db_name, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.executescript(_TUNING_PRAGMAS)
+        # The WAL is checkpointed explicitly by _write_batch.
+        conn.execute("PRAGMA wal_autocheckpoint=0;")
+        # Rows removed by INSERT OR REPLACE only fire delete triggers with this.
+        conn.execute("PRAGMA recursive_triggers=ON;")
+        (version,) = conn.execute("PRAGMA user_version;").fetchone()
+        if version != SCHEMA_VERSION:
+            # Cached responses can always be fetched again, so an outdated
+            # table is dropped instead of migrated.
+            conn.execute("DROP TABLE IF EXISTS cache")
+            conn.execute("DROP TABLE IF EXISTS metadata")
+            conn.execute(f"PRAGMA user_version={SCHEMA_VERSION};")
+        conn.executescript(
             """
             CREATE TABLE IF NOT EXISTS cache (
                 url TEXT PRIMARY KEY,
-                content BLOB,
-                headers TEXT,
-                status_code INTEGER,
+                path TEXT,
+                response_head BLOB,
                 expected_size INTEGER,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
+                timestamp INTEGER DEFAULT (strftime('%s', 'now'))
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_cache_path ON cache(path);
+            CREATE TABLE IF NOT EXISTS metadata (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            );
+            INSERT OR IGNORE INTO metadata (key, value)
+                SELECT 'cache_size', COALESCE(SUM(expected_size), 0) FROM cache;
+            CREATE TRIGGER IF NOT EXISTS cache_size_insert AFTER INSERT ON cache
+            BEGIN
+                UPDATE metadata SET value = value + NEW.expected_size
+                    WHERE key = 'cache_size';
+            END;
+            CREATE TRIGGER IF NOT EXISTS cache_size_delete AFTER DELETE ON cache
+            BEGIN
+                UPDATE metadata SET value = value - OLD.expected_size
+                    WHERE key = 'cache_size';
+            END;
         """
         )
-        await self.conn.commit()
+
+    def _recreate(self, reason):
+        """
+        @brief Replace a corrupted database with an empty one on the writer thread.
+
+        Commits skip fsync, so an OS crash can leave the database damaged.
+        Cached responses can be fetched again, so the file is deleted rather
+        than repaired; the body files it referenced are removed afterwards by
+        verify_integrity.
+
+        @param reason Description of the corruption that was detected.
+        """
+        logger.error(f"Database is corrupted ({reason}), recreating it")
+        if self.write_conn is not None:
+            self.write_conn.close()
+            self.write_conn = None
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(self.db_name + suffix)
+            except FileNotFoundError:
+                pass
+        self._open_writer()
+
+    async def init(self):
+        """
+        @brief Initialize the database connections, create table if needed,
+               verify integrity, and start the background write worker.
+
+        Reads go through an aiosqlite connection; WAL mode lets them proceed
+        while the writer thread commits a batch on its own sqlite3 connection.
+        """
+        try:
+            await self._run_writer(self._open_writer)
+        except sqlite3.DatabaseError as e:
+            if not _is_corruption(e):
+                raise
+            await self._run_writer(self._recreate, e)
+        self.store.init()
+        # Opened after the check, which may replace the database file.
         await self.verify_integrity()
+        self.read_conn = await self._connect()
         self.worker_task = asyncio.create_task(self._write_worker())
 
     async def verify_integrity(self):
         """
         @brief Verify the database integrity and remove corrupted cache entries.
 
-        Corrupted entries are defined as those where the stored content length
-        does not match the expected size.
-        """
-        async with self.lock:
-            async with self.conn.execute("PRAGMA integrity_check;") as cursor:
-                result = await cursor.fetchone()
-                if result[0] != "ok":
-                    raise Exception("Database integrity check failed: " + result[0])
-            async with self.conn.execute(
-                "SELECT url, LENGTH(content), expected_size FROM cache"
-            ) as cursor:
-                async for row in cursor:
-                    url, actual_size, expected_size = row
-                    if expected_size is not None and actual_size != expected_size:
-                        await self.conn.execute(
-                            "DELETE FROM cache WHERE url = ?", (url,)
-                        )
-            await self.conn.commit()
+        A database that fails PRAGMA integrity_check is recreated empty.
+        Corrupted entries are defined as those whose body file is missing or
+        does not match the expected size. Body files that no remaining entry
+        refers to are deleted afterwards.
+        """
+        await self._run_writer(self._verify_integrity)
+
+    def _verify_integrity(self):
+        """
+        @brief Writer-thread implementation of verify_integrity.
+        """
+        try:
+            (result,) = self.write_conn.execute("PRAGMA integrity_check;").fetchone()
+        except sqlite3.DatabaseError as e:
+            if not _is_corruption(e):
+                raise
+            result = e
+        if result != "ok":
+            self._recreate(result)
+        conn = self.write_conn
+        referenced = set()
+        corrupted = []
+        for url, path, expected_size in conn.execute(
+            "SELECT url, path, expected_size FROM cache"
+        ):
+            if self.store.size(path) != expected_size:
+                corrupted.append((url,))
+            else:
+                referenced.add(path)
+        if corrupted:
+            conn.execute("BEGIN")
+            conn.executemany("DELETE FROM cache WHERE url = ?", corrupted)
+            conn.commit()
+        self.store.remove_unreferenced(referenced)
+
+    def _write_batch(self, values, dropped=()):
+        """
+        @brief Insert a batch of rows in a single transaction on the writer thread.
+
+        Afterwards, body files that no row references any more are deleted:
+        those of replaced rows and of dropped items, or of the whole batch if
+        it was rolled back. Every CHECKPOINT_INTERVAL batches the WAL is
+        checkpointed and truncated.
+
+        @param values List of row tuples matching _INSERT_SQL.
+        @param dropped Paths of queued bodies that were left out of values.
+        """
+        conn = self.write_conn
+        replaced = set(dropped)
+        try:
+            conn.execute("BEGIN")
+            for row in values:
+                old = conn.execute(
+                    "SELECT path FROM cache WHERE url = ?", (row[0],)
+                ).fetchone()
+                if old and old[0] != row[1]:
+                    replaced.add(old[0])
+            conn.executemany(_INSERT_SQL, values)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            replaced = set(dropped)
+            replaced.update(row[1] for row in values)
+        try:
+            for path in replaced:
+                if not conn.execute(
+                    "SELECT 1 FROM cache WHERE path = ? LIMIT 1", (path,)
+                ).fetchone():
+                    self.store.remove(path)
+        except Exception as e:
+            logger.error(f"Error removing unreferenced cache bodies: {e}")
+        self.batches_since_checkpoint += 1
+        if self.batches_since_checkpoint >= CHECKPOINT_INTERVAL:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+            self.batches_since_checkpoint = 0
+
+    def _close_writer(self):
+        """
+        @brief Optimize and close the write connection on the writer thread.
+        """
+        self.write_conn.execute("PRAGMA optimize;")
+        self.write_conn.close()
 
     async def _write_worker(self):
         """
@@ -91,42 +327,30 @@ class CacheDatabase:
                         self.write_queue.get(), timeout=BATCH_INTERVAL
                     )
                     batch.append(item)
-                    for _ in range(BATCH_SIZE - 1):
-                        try:
-                            item = self.write_queue.get_nowait()
-                            batch.append(item)
-                        except asyncio.QueueEmpty:
-                            break
+                    batch.extend(self.write_queue.drain_up_to(BATCH_SIZE - 1))
                 except asyncio.TimeoutError:
                     if not batch:
                         continue
 
                 if batch:
-                    # Format current time to match SQLite's DEFAULT CURRENT_TIMESTAMP format
-                    current_time = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+                    # Keep only the most recent entry per URL; later items win.
+                    latest = {item[0]: item for item in batch}
+                    # Unix seconds, matching the column's DEFAULT
+                    current_time = int(time.time())
                     values = [
-                        (
-                            url,
-                            content,
-                            json.dumps(headers),
-                            status_code,
-                            expected_size,
-                            current_time,
-                        )
-                        for url, content, headers, status_code, expected_size in batch
+                        (url, path, head, expected_size, current_time)
+                        for url, path, head, expected_size in latest.values()
+                    ]
+                    # Bodies of superseded items are already on disk.
+                    dropped = [
+                        item[1] for item in batch if latest[item[0]] is not item
                     ]
-                    async with self.lock:
-                        try:
-                            await self.conn.execute("BEGIN")
-                            await self.conn.executemany(
-                                "INSERT OR REPLACE INTO cache (url, content, headers, status_code, expected_size, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-                                values,
-                            )
-                            await self.conn.commit()
-                        except Exception as e:
-                            await self.conn.rollback()
-                    for _ in batch:
-                        self.write_queue.task_done()
+                    try:
+                        await self._run_writer(self._write_batch, values, dropped)
+                    finally:
+                        # Always settle the batch so shutdown()'s join() returns.
+                        for _ in batch:
+                            self.write_queue.task_done()
             except Exception as e:
                 # Simple error logging; for production integrate with a proper logging system.
                 print(f"Error in write worker: {e}")
@@ -135,54 +359,53 @@ class CacheDatabase:
         """
         @brief Retrieve a cached response for the given URL if it is not expired.
         @param url The URL for which to retrieve the cached response.
-        @return A dictionary with 'content', 'headers', and 'status_code' if found, otherwise None.
-        """
-        expiration = (
-            datetime.utcnow() - timedelta(seconds=CACHE_EXPIRATION_SECONDS)
-        ).strftime("%Y-%m-%d %H:%M:%S")
-        async with self.lock:
-            async with self.conn.execute(
-                "SELECT content, headers, status_code FROM cache WHERE url = ? AND timestamp > ?",
-                (url, expiration),
-            ) as cursor:
-                row = await cursor.fetchone()
+        @return A dictionary with 'head' (the rendered response head), 'path'
+                (absolute path of the body file) and 'expires_at' (unix seconds)
+                if found, otherwise None.
+        """
+        expiration = int(time.time()) - CACHE_EXPIRATION_SECONDS
+        async with self.read_conn.execute(
+            "SELECT response_head, path, timestamp FROM cache WHERE url = ? AND timestamp > ?",
+            (url, expiration),
+        ) as cursor:
+            row = await cursor.fetchone()
         if row:
-            content, headers_json, status_code = row
+            head, path, timestamp = row
             return {
-                "content": content,
-                "headers": json.loads(headers_json),
-                "status_code": status_code,
+                "head": head,
+                "path": self.store.full_path(path),
+                "expires_at": timestamp + CACHE_EXPIRATION_SECONDS,
             }
         return None
 
-    async def cache_response(
-        self, url: str, content: bytes, headers: dict, status_code: int
-    ):
+    async def cache_response(self, url: str, path: str, size: int, head: bytes):
         """
-        @brief Enqueue a cache write operation.
+        @brief Enqueue a cache write operation, waiting while the queue is full.
         @param url The URL associated with the response.
-        @param content The response content as bytes.
-        @param headers The response headers as a dictionary.
-        @param status_code The HTTP status code of the response.
+        @param path The relative path of the body in the BodyStore.
+        @param size The size of the body in bytes.
+        @param head The rendered response head replayed on cache hits.
         """
-        expected_size = int(headers.get("Content-Length", len(content)))
-        await self.write_queue.put((url, content, headers, status_code, expected_size))
+        await self.write_queue.put((url, path, head, size))
 
     async def get_total_size(self):
         """
-        @brief Calculate the total size in bytes of all cached content.
+        @brief Get the total size in bytes of all cached content.
+
+        Reads the running total maintained by the metadata triggers instead of
+        scanning the cache table.
+
         @return Total size in bytes.
         """
-        async with self.lock:
-            async with self.conn.execute(
-                "SELECT SUM(LENGTH(content)) FROM cache"
-            ) as cursor:
-                row = await cursor.fetchone()
-                return row[0] or 0
+        async with self.read_conn.execute(
+            "SELECT value FROM metadata WHERE key = 'cache_size'"
+        ) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else 0
 
     async def shutdown(self):
         """
-        @brief Shutdown the database by finishing pending writes and closing the connection.
+        @brief Shutdown the database by finishing pending writes and closing the connections.
         """
         await self.write_queue.join()
         if self.worker_task:
@@ -191,5 +414,8 @@ class CacheDatabase:
                 await self.worker_task
             except asyncio.CancelledError:
                 pass
-        if self.conn:
-            await self.conn.close()
+        if self.read_conn:
+            await self.read_conn.close()
+        if self.write_conn:
+            await self._run_writer(self._close_writer)
+        self.writer.shutdown()
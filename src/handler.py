@@ -6,8 +6,52 @@
 
 import asyncio
 import aiohttp
+import httptools
 import socket  # Required for setting socket options.
+import time
+from config import MEMORY_CACHE_MAX_ITEM_SIZE
 from logger import logger
+from response import build_response_head
+
+# Size of the chunks read from upstream and relayed to the client.
+CHUNK_SIZE = 65536
+# Largest request line plus headers accepted from a client.
+MAX_REQUEST_HEAD_SIZE = 65536
+
+
+class RequestHead:
+    """
+    @brief Collects the request target and headers reported by httptools.
+    """
+
+    def __init__(self):
+        """
+        @brief Initialize an empty RequestHead.
+        """
+        self.url = b""
+        self.headers = {}
+        self.complete = False
+
+    def on_url(self, url: bytes):
+        """
+        @brief Parser callback receiving (part of) the request target.
+        @param url The received bytes.
+        """
+        self.url += url
+
+    def on_header(self, name: bytes, value: bytes):
+        """
+        @brief Parser callback receiving one complete header.
+        @param name The header name.
+        @param value The header value.
+        """
+        self.headers[name.decode("latin-1")] = value.decode("latin-1")
+
+    def on_headers_complete(self):
+        """
+        @brief Parser callback fired once the blank line ending the headers is seen.
+        """
+        self.complete = True
 
 
 class ProxyHandler:
@@ -45,45 +89,124 @@ class ProxyHandler:
 
     async def fetch_and_forward(self, url, writer, cache_enabled=True):
         """
-        @brief Fetch a remote URL and forward the response to the client.
+        @brief Fetch a remote URL and stream the response to the client.
+
+        Chunks are written to the client as they arrive and, for cacheable
+        responses, to the on-disk body store. Only bodies up to
+        MEMORY_CACHE_MAX_ITEM_SIZE are also buffered for the in-memory cache.
+        The entry is queued for the database only after the client connection
+        and the upstream response are released, since the bounded write queue
+        may block.
+
         @param url The URL to fetch.
         @param writer The client's stream writer.
         @param cache_enabled Flag to enable caching of successful responses.
         """
+        headers_sent = False
+        entry = None
         try:
             async with self.session.get(url) as resp:
-                content = await resp.read()
                 status = resp.status
                 headers = dict(resp.headers)
+                content_length = resp.content_length
 
-                # Remove chunked transfer and set a proper Content-Length header.
+                # The body is relayed as-is, so keep the upstream Content-Length;
+                # without one the body is delimited by closing the connection.
                 headers.pop("Transfer-Encoding", None)
-                headers["Content-Length"] = str(len(content))
-
-                # Write status line and headers to the client.
-                response_line = f"HTTP/1.1 {status} {resp.reason}\r\n"
-                writer.write(response_line.encode())
-                for key, value in headers.items():
-                    writer.write(f"{key}: {value}\r\n".encode())
-                writer.write(b"\r\n")
-                writer.write(content)
-                await writer.drain()
+                if content_length is None:
+                    headers["Connection"] = "close"
 
-                # Cache the response if enabled and successful.
-                if cache_enabled and status == 200:
-                    await self.db.cache_response(url, content, headers, status)
-                    await self.memory_cache.set(
-                        url,
-                        {"content": content, "headers": headers, "status_code": status},
-                    )
+                writer.write(build_response_head(status, resp.reason, headers))
+                headers_sent = True
+
+                if not (cache_enabled and status == 200):
+                    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                        writer.write(chunk)
+                        await writer.drain()
+                    return
+
+                body = await self.db.store.open_writer()
+                try:
+                    content = bytearray()
+                    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                        writer.write(chunk)
+                        await body.write(chunk)
+                        if content is not None:
+                            if len(content) + len(chunk) <= MEMORY_CACHE_MAX_ITEM_SIZE:
+                                content.extend(chunk)
+                            else:
+                                content = None
+                        await writer.drain()
+
+                    # Only complete bodies are cached.
+                    if content_length is None or body.size == content_length:
+                        path = await body.commit()
+                        headers.pop("Connection", None)
+                        headers["Content-Length"] = str(body.size)
+                        # Rendered once here and replayed verbatim on every hit.
+                        head = build_response_head(status, "OK", headers)
+                        entry = (path, body.size, head)
+                        if content is not None:
+                            self.memory_cache.set(
+                                url, {"head": head, "content": content}
+                            )
+                finally:
+                    await body.abort()
         except aiohttp.ClientError as e:
-            error_response = f"HTTP/1.1 502 Bad Gateway\r\n\r\n{e}"
-            writer.write(error_response.encode())
-            await writer.drain()
+            # Once the body has started there is no way to signal the error
+            # other than dropping the connection.
+            if not headers_sent:
+                error_response = f"HTTP/1.1 502 Bad Gateway\r\n\r\n{e}"
+                writer.write(error_response.encode())
+                await writer.drain()
         finally:
             writer.close()
             await writer.wait_closed()
 
+        if entry is not None:
+            await self.db.cache_response(url, *entry)
+
+    async def send_cached(self, writer, cached):
+        """
+        @brief Send a cached response to the client.
+
+        Bodies held in memory are written directly; bodies on disk are handed
+        to loop.sendfile, which uses os.sendfile when the transport allows it.
+        Event loops without sendfile support (uvloop) get the file copied in
+        chunks instead.
+
+        @param writer The client's stream writer.
+        @param cached The cached response.
+        @return False if the cached body file has gone missing, True otherwise.
+        """
+        try:
+            body = None if "content" in cached else open(cached["path"], "rb")
+        except FileNotFoundError:
+            return False
+        try:
+            writer.write(cached["head"])
+            if body is None:
+                writer.write(cached["content"])
+                await writer.drain()
+            else:
+                await writer.drain()
+                loop = asyncio.get_running_loop()
+                try:
+                    await loop.sendfile(writer.transport, body)
+                except NotImplementedError:
+                    while True:
+                        chunk = await loop.run_in_executor(None, body.read, CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        writer.write(chunk)
+                        await writer.drain()
+        finally:
+            if body is not None:
+                body.close()
+        writer.close()
+        await writer.wait_closed()
+        return True
+
     async def send_error(self, writer, status_code=400, reason="Bad Request"):
         """
         @brief Send an error response to the client.
@@ -110,29 +233,36 @@ class ProxyHandler:
         if sock:
             sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
+        head = RequestHead()
+        parser = httptools.HttpRequestParser(head)
+        received = 0
+        # Bytes following the request head, forwarded as-is for CONNECT.
+        leftover = b""
         try:
-            request_line = await reader.readline()
-            if not request_line:
-                writer.close()
-                await writer.wait_closed()
-                return
-
-            parts = request_line.decode().strip().split()
-            if len(parts) < 3:
-                raise ValueError("Incomplete request line")
-            method, path, _ = parts
+            while not head.complete:
+                data = await reader.read(CHUNK_SIZE)
+                if not data:
+                    break
+                received += len(data)
+                if received > MAX_REQUEST_HEAD_SIZE:
+                    raise ValueError("Request head too large")
+                try:
+                    parser.feed_data(data)
+                except httptools.HttpParserUpgrade as e:
+                    leftover = data[e.args[0] :]
+            if not head.complete:
+                if received == 0:
+                    writer.close()
+                    await writer.wait_closed()
+                    return
+                raise ValueError("Incomplete request head")
+            method = parser.get_method().decode()
+            path = head.url.decode("latin-1")
         except Exception:
             await self.send_error(writer)
             return
 
-        headers = {}
-        while True:
-            line = await reader.readline()
-            if line in (b"\r\n", b""):
-                break
-            key, sep, value = line.decode().partition(":")
-            if sep:
-                headers[key.strip()] = value.strip()
+        headers = head.headers
 
         url = (
             path
@@ -155,6 +285,8 @@ class ProxyHandler:
 
             writer.write(b"HTTP/1.1 200 Connection Established\r\n\r\n")
             await writer.drain()
+            if leftover:
+                remote_writer.write(leftover)
 
             task1 = asyncio.create_task(self.forward(reader, remote_writer))
             task2 = asyncio.create_task(self.forward(remote_reader, writer))
@@ -177,19 +309,17 @@ class ProxyHandler:
         elif method.upper() == "GET":
             # Try to retrieve from in-memory or persistent cache.
             try:   
-                cached = await self.memory_cache.get(url) or await self.db.get_cached(url)
+                cached = self.memory_cache.get(url)
+                if cached is None:
+                    cached = await self.db.get_cached(url)
+                    if cached:
+                        # Keep the entry in memory for as long as it stays valid on disk.
+                        self.memory_cache.set(
+                            url, cached, ttl=cached["expires_at"] - time.time()
+                        )
                 logger.info(f"Requesting {url}")
-                if cached:
+                if cached and await self.send_cached(writer, cached):
                     logger.info(f"Cache hit for {url}")
-                    response_line = f"HTTP/1.1 {cached['status_code']} OK\r\n"
-                    writer.write(response_line.encode())
-                    for key, value in cached["headers"].items():
-                        writer.write(f"{key}: {value}\r\n".encode())
-                    writer.write(b"\r\n")
-                    writer.write(cached["content"])
-                    await writer.drain()
-                    writer.close()
-                    await writer.wait_closed()
                 else:
                     logger.info(f"Cache miss for {url}")
                     await self.fetch_and_forward(url, writer)
@@ -1,19 +1,21 @@
 #!/usr/bin/env python3
 """
 @file memory_cache.py
-@brief In-memory caching module using TTLCache.
+@brief In-memory caching module using a time-limited LRU.
 """
 
-import asyncio
-from cachetools import TTLCache
+import time
+from collections import OrderedDict
 from config import CACHE_EXPIRATION_SECONDS
 
 
 class MemoryCache:
     """
-    @brief Provides an asynchronous in-memory cache with time-to-live support.
+    @brief Provides an in-memory LRU cache with time-to-live support.
 
-    Uses cachetools.TTLCache and an asyncio lock to protect concurrent access.
+    Entries are kept in an OrderedDict from least to most recently used. Each
+    operation is a few dict calls with no await in between, so it cannot be
+    interleaved on the event loop and needs no lock.
     """
 
     def __init__(self, maxsize=1000, ttl=CACHE_EXPIRATION_SECONDS):
@@ -22,23 +24,36 @@ class MemoryCache:
         @param maxsize Maximum number of items in the cache.
         @param ttl Time-to-live (in seconds) for each cached item.
         """
-        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
-        self.lock = asyncio.Lock()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.cache = OrderedDict()
 
-    async def get(self, url: str):
+    def get(self, url: str):
         """
         @brief Retrieve a cached response for the given URL.
         @param url The URL key to look up.
-        @return The cached response or None if not found.
+        @return The cached response or None if not found or expired.
         """
-        async with self.lock:
-            return self.cache.get(url)
+        entry = self.cache.get(url)
+        if entry is None:
+            return None
+        expires_at, response = entry
+        if time.monotonic() > expires_at:
+            del self.cache[url]
+            return None
+        self.cache.move_to_end(url)
+        return response
 
-    async def set(self, url: str, response: dict):
+    def set(self, url: str, response: dict, ttl=None):
         """
         @brief Set a cached response for the given URL.
         @param url The URL key.
         @param response The response data to cache.
+        @param ttl Time-to-live (in seconds) for this item; defaults to the cache's ttl.
         """
-        async with self.lock:
-            self.cache[url] = response
+        if ttl is None:
+            ttl = self.ttl
+        self.cache[url] = (time.monotonic() + ttl, response)
+        self.cache.move_to_end(url)
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+"""
+@file response.py
+@brief Helpers for rendering HTTP responses sent to clients.
+"""
+
+
+def build_response_head(status_code: int, reason: str, headers: dict):
+    """
+    @brief Render an HTTP/1.1 status line and header block as a single buffer.
+    @param status_code HTTP status code.
+    @param reason Reason phrase for the status line.
+    @param headers The response headers as a dictionary.
+    @return The encoded head, including the blank line that ends it.
+    """
+    lines = [f"HTTP/1.1 {status_code} {reason}\r\n"]
+    lines.extend(f"{key}: {value}\r\n" for key, value in headers.items())
+    lines.append("\r\n")
+    # aiohttp decodes header bytes as UTF-8 with surrogateescape; encoding the
+    # same way reproduces the upstream bytes, even ones that are not UTF-8.
+    return "".join(lines).encode("utf-8", "surrogateescape")